@@ -43,13 +43,14 @@ def general(all_contexts, all_rewards, stationarity_periods, max_num_observation
 
     sum_of_rewards = np.zeros((num_stationarity_periods, number_of_perms_general, s_o_max_general, number_of_actions))
 
+    # Masked contexts for the current observation action, one buffer reused for all of them.
+    all_contexts_temp = np.empty(all_contexts.shape)
+
     for i in range(number_of_perms_general):
 
         one_perm = all_perms[i]
 
-        O_temp = np.tile(one_perm, [time_horizon, 1])
-
-        all_contexts_temp = all_contexts * O_temp  # a*b element.wise multiplication, np.multiply(a,b) is also correct
+        np.multiply(all_contexts, one_perm, out=all_contexts_temp)  # one_perm is broadcast over the rows of all_contexts
 
         # S_i is the matrix whose rows are the unique(between already existing contexts) state realizations of all of the contexts with observation action one_perm[i]
         S_i = np.unique(all_contexts_temp, axis=0)
@@ -134,7 +135,9 @@ class Algorithm1_Oracle:
         self.true_average_rewards = np.zeros((self.time_horizon, self.number_of_actions))
 
         ########################################################################################
-        self.feature_values, self.all_feature_counts = utilities.save_feature_values(all_contexts)
+        self.feature_values, self.all_feature_counts, self.feature_value_to_index = utilities.save_feature_values(
+            all_contexts
+        )
 
         for i in range(self.number_of_perms):
             # psi[i] = number of different partial vectors(realizations) with given observation action self.all_perms[i]
@@ -179,6 +182,12 @@ class Algorithm1_Oracle:
             self.index_of_observation_action_star[num_per] = int(np.argmax(self.value_o[num_per, :]))
             self.selected_observation_action_at_t[num_per, :] = self.all_perms[self.index_of_observation_action_star[num_per]]
 
+        # Observation is fixed during each stationarity period, so state extraction is specialized for each of them.
+        self._state_extract_by_period = [
+            utilities.make_state_extract(self.feature_value_to_index, self.all_feature_counts, observation_action)
+            for observation_action in self.selected_observation_action_at_t
+        ]
+
     def validate_stationarity_periods(self, stationarity_periods):
         assert stationarity_periods == sorted(stationarity_periods)
 
@@ -199,7 +208,7 @@ class Algorithm1_Oracle:
             pool_indices: indices of arms available at time t.
         """
         num_per = get_ind_of_stationarity_period_by_t(t, self.stationarity_periods)
-        s_t = utilities.state_extract(self.feature_values, self.all_feature_counts, context_at_t, self.observation_action_at_t)
+        s_t = self._state_extract_by_period[num_per](context_at_t)
         self.states[t] = s_t
         self.true_average_rewards[t, :] = self.true_average_reward[num_per, self.index_of_observation_action_star[num_per], s_t]
 
@@ -1,66 +1,75 @@
 import datetime
+import numba
 import numpy as np
 
 from src.algorithms import utilities
 
 
-def general(all_contexts, all_rewards, max_num_observations, s_o_max_general):
-    time_horizon = all_rewards.shape[0]
-    number_of_actions = all_rewards.shape[1]
-    context_dimensionality = all_contexts.shape[1]
-
-    all_perms = utilities.perm_construct(context_dimensionality, max_num_observations)
-    number_of_perms_general = all_perms.shape[0]
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _general_kernel(feature_indices, all_rewards, all_multipliers, s_o_max_general):
+    """Compiled part of general, parallel over observation actions.
 
-    selected_context_general = np.zeros((time_horizon, context_dimensionality))
-    selected_action_general = np.zeros(time_horizon)
-    all_gain_general = np.zeros(time_horizon + 1)
-
-    number_of_unique_state_s_when_applying_perm_i = np.zeros((number_of_perms_general, s_o_max_general))
-
-    # d_os = np.zeros((number_of_perms_general, s_o_max_general)) #Definition: N_os / N_o
-    true_prob_so = np.zeros((number_of_perms_general,
-                             s_o_max_general))  # Definition: number_of_unique_state_s_when_applying_perm_i / time_horizon
+    feature_indices[t, c] is the index of the value of feature c at time t among sorted values of feature c,
+    all_multipliers[i] are the state multipliers of observation action i (see utilities.state_multipliers).
+    """
+    time_horizon, number_of_actions = all_rewards.shape
+    number_of_perms_general, context_dimensionality = all_multipliers.shape
 
+    # Single precision is enough for comparing rewards and weighting them by probabilities, counts and sums
+    # below are still accumulated in double precision.
+    true_prob_so = np.zeros((number_of_perms_general, s_o_max_general), dtype=np.float32)
+    true_average_reward = np.zeros((number_of_perms_general, s_o_max_general, number_of_actions), dtype=np.float32)
     S_Size = np.zeros(number_of_perms_general)
 
-    true_average_reward = np.zeros((number_of_perms_general, s_o_max_general, number_of_actions))
+    for i in numba.prange(number_of_perms_general):
+        # Counts and reward sums indexed by the positional state index (from 0 to s_o[i]-1)
+        number_of_visits = np.zeros(s_o_max_general)
+        sum_of_rewards = np.zeros((s_o_max_general, number_of_actions))
 
-    number_of_visits_for_average_reward = np.zeros((number_of_perms_general, s_o_max_general, number_of_actions))
+        for t in range(time_horizon):
+            state_index = 0
+            for c in range(context_dimensionality):
+                state_index += all_multipliers[i, c] * feature_indices[t, c]
 
-    sum_of_rewards = np.zeros((number_of_perms_general, s_o_max_general, number_of_actions))
-
-    for i in range(number_of_perms_general):
-
-        one_perm = all_perms[i]
+            number_of_visits[state_index] += 1
+            for k in range(number_of_actions):
+                sum_of_rewards[state_index, k] += all_rewards[t, k]
 
-        O_temp = np.tile(one_perm, [time_horizon, 1])
+        # Only states present in the contexts are kept. Positional index increases with the lexicographic order
+        # of the observed values, so states are numbered in the same order as the rows of np.unique(..., axis=0).
+        j = 0
+        for state_index in range(s_o_max_general):
+            if number_of_visits[state_index] == 0:
+                continue
 
-        all_contexts_temp = all_contexts * O_temp  # a*b element.wise multiplication, np.multiply(a,b) is also correct
+            true_prob_so[i, j] = number_of_visits[state_index] / time_horizon
+            for k in range(number_of_actions):
+                true_average_reward[i, j, k] = sum_of_rewards[state_index, k] / number_of_visits[state_index]
+            j += 1
 
-        # S_i is the matrix whose rows are the unique(between already existing contexts) state realizations of all of the contexts with observation action one_perm[i]
-        S_i = np.unique(all_contexts_temp, axis=0)
+        S_Size[i] = j
 
-        # number of unique state realizations for each domain
-        # it has a subtle difference with s_o[i] = number of different states(realizations) with the same observation action all_perms[i]
-        S_Size[i] = S_i.shape[0]
+    return true_prob_so, true_average_reward, S_Size
 
-        for j in range(int(S_Size[i])):
 
-            all_unique_state_s_when_applying_perm_i = (all_contexts_temp == S_i[j, :]).all(1)
-            number_of_unique_state_s_when_applying_perm_i[i, j] = number_of_unique_state_s_when_applying_perm_i[
-                                                                      i, j] + np.sum(
-                all_unique_state_s_when_applying_perm_i)
+def general(all_contexts, all_rewards, max_num_observations, s_o_max_general):
+    context_dimensionality = all_contexts.shape[1]
 
-            true_prob_so[i, j] = number_of_unique_state_s_when_applying_perm_i[i, j] / time_horizon
+    all_perms = utilities.perm_construct(context_dimensionality, max_num_observations)
 
-            all_rewards_temp = all_rewards[all_unique_state_s_when_applying_perm_i, :]
+    # Contexts are encoded by indices of feature values, so that states can be identified by
+    # their positional index instead of comparing context rows.
+    feature_indices = np.zeros(all_contexts.shape, dtype=np.int64)
+    feature_counts = np.zeros(context_dimensionality)
+    for c in range(context_dimensionality):
+        values, feature_indices[:, c] = np.unique(all_contexts[:, c], return_inverse=True)
+        feature_counts[c] = values.shape[0]
 
-            for k in range(number_of_actions):
-                number_of_visits_for_average_reward[i, j, k] = all_rewards_temp[:, k].shape[0]
-                sum_of_rewards[i, j, k] = np.sum(all_rewards_temp[:, k])
+    all_multipliers = np.array([utilities.state_multipliers(feature_counts, perm) for perm in all_perms])
 
-                true_average_reward[i, j, k] = sum_of_rewards[i, j, k] / number_of_visits_for_average_reward[i, j, k]
+    true_prob_so, true_average_reward, S_Size = _general_kernel(
+        feature_indices, np.ascontiguousarray(all_rewards, dtype=np.float64), all_multipliers, s_o_max_general
+    )
 
     return [true_prob_so, true_average_reward, S_Size]
 
@@ -100,7 +109,11 @@ class SimOOS_Oracle:
         self.number_of_perms = self.all_perms.shape[0]
         self.s_o = np.zeros(self.number_of_perms)
 
-        self.selected_context = np.zeros((self.time_horizon, self.context_dimensionality))
+        # Number of trials the oracle was updated on, selected_context is derived from it.
+        self.number_of_updated_trials = 0
+        # Materialized selected_context and number of updated trials it was built for.
+        self._selected_context = None
+        self._selected_context_trials = None
         self.selected_action = np.zeros(self.time_horizon)
         self.all_gain = np.zeros(self.time_horizon + 1)
 
@@ -113,7 +126,9 @@ class SimOOS_Oracle:
         self.true_average_rewards = np.zeros((self.time_horizon, self.number_of_actions))
 
         ########################################################################################
-        self.feature_values, self.all_feature_counts = utilities.save_feature_values(all_contexts)
+        self.feature_values, self.all_feature_counts, self.feature_value_to_index = utilities.save_feature_values(
+            all_contexts
+        )
 
         for i in range(self.number_of_perms):
             # psi[i] = number of different partial vectors(realizations) with given observation action self.all_perms[i]
@@ -133,25 +148,39 @@ class SimOOS_Oracle:
             all_contexts, all_rewards, self.max_num_observations, self.s_o_max
         )
 
-        self.r_star = np.zeros((self.number_of_perms, self.s_o_max))
-        self.action_star = np.zeros((self.number_of_perms, self.s_o_max))
+        # States beyond S_Size[i] have zero rewards, so they get r_star 0 and have no weight in value_o
+        # since their true_prob_so is 0.
+        self.r_star = self.true_average_reward.max(axis=2)
+        self.action_star = self.true_average_reward.argmax(axis=2)
 
-        for i in range(self.number_of_perms):
-
-            for j in range(int(self.S_Size[i])):
-                self.r_star[i, j] = np.max(self.true_average_reward[i, j, :])
+        # value_o[i] = beta * <true_prob_so[i], r_star[i]> - <all_perms[i], cost_vector>, for all observations at once.
+        # Rewards and probabilities are float32 (see general), value_o is kept in float64 for the argmax.
+        self.value_o = (
+            self.beta * np.einsum('ij,ij->i', self.true_prob_so, self.r_star).astype(np.float64)
+            - self.all_perms @ cost_vector
+        )
 
-                self.action_star[i, j] = np.argmax(self.true_average_reward[i, j, :])
+        self.index_of_observation_action_star = np.argmax(self.value_o)
 
-        self.value_o = np.zeros(self.number_of_perms)
+        self.selected_observation_action_at_t = self.all_perms[self.index_of_observation_action_star]
+        # Observation is fixed for the whole time horizon, so positional multipliers of states are computed once.
+        self._mult = utilities.state_multipliers(self.all_feature_counts, self.selected_observation_action_at_t)
+        # State at each trial is also known in advance, provided the oracle is evaluated on all_contexts in order.
+        self._state_of_trial = utilities.contexts_to_feature_indices(self.feature_values, all_contexts) @ self._mult
 
-        for i in range(self.number_of_perms):
-            self.value_o[i] = self.beta * np.dot(self.true_prob_so[i, :], self.r_star[i, :]) - np.dot(self.all_perms[i],
-                                                                                                cost_vector)
+    @property
+    def selected_context(self) -> np.array:
+        """Observation selected at each trial, zeros for trials that have not happened yet.
 
-        self.index_of_observation_action_star = np.argmax(self.value_o)
+        Observation is fixed for the whole time horizon, so it is not stored for every trial. The array is built
+        on first access and rebuilt only after the oracle was updated on more trials.
+        """
+        if self._selected_context_trials != self.number_of_updated_trials:
+            self._selected_context = np.zeros((self.time_horizon, self.context_dimensionality))
+            self._selected_context[:self.number_of_updated_trials, :] = self.selected_observation_action_at_t
+            self._selected_context_trials = self.number_of_updated_trials
 
-        self.selected_observation_action_at_t = self.all_perms[self.index_of_observation_action_star]
+        return self._selected_context
 
     def choose_features_to_observe(self, t, feature_indices, cost_vector):
         self.observation_action_at_t = self.selected_observation_action_at_t
@@ -165,7 +194,7 @@ class SimOOS_Oracle:
             context_at_t: user context at time t. One for each trial, arms don't have contexts.
             pool_indices: indices of arms available at time t.
         """
-        s_t = utilities.state_extract(self.feature_values, self.all_feature_counts, context_at_t, self.observation_action_at_t)
+        s_t = int(self._state_of_trial[t])
         self.states[t] = s_t
         self.true_average_rewards[t, :] = self.true_average_reward[self.index_of_observation_action_star, s_t]
 
@@ -180,7 +209,7 @@ class SimOOS_Oracle:
 
         action_at_t = pool_indices[action_index_at_t]
 
-        self.selected_context[t, :] = self.selected_observation_action_at_t
+        self.number_of_updated_trials = t + 1
 
         self.all_gain[t + 1] = self.all_gain[t] + reward_at_t - cost_at_t
 
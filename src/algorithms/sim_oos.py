@@ -81,12 +81,19 @@ class SimOOSAlgorithm:
 
         ########################################################################################
         # Feature values and counts are used to extract state index s_t for a given observation and partial context.
-        self.feature_values, self.all_feature_counts = utilities.save_feature_values(all_contexts)
+        self.feature_values, self.all_feature_counts, self.feature_value_to_index = utilities.save_feature_values(
+            all_contexts
+        )
 
         for i in range(self.number_of_perms):
             # s_o[i] - size of state array for a given observation action.
             self.s_o[i] = utilities.state_construct(self.all_feature_counts, all_contexts, self.all_perms[i])
 
+        # Positional multipliers of states for each observation, used to number the encoded substates.
+        self.perm_multipliers = np.array([
+            utilities.state_multipliers(self.all_feature_counts, perm) for perm in self.all_perms
+        ])
+
         # s_o_max - the largest state vector for all observations, needed to create arrays.
         self.s_o_max = int(np.amax(self.s_o))
         # Total number of possible partial state vectors.
@@ -216,7 +223,7 @@ class SimOOSAlgorithm:
             self.action_at_t = np.random.choice(pool_indices)
         else:
             # Optimistic Policy Optimization
-            s_t = utilities.state_extract(self.feature_values, self.all_feature_counts, context_at_t,
+            s_t = utilities.state_extract(self.feature_value_to_index, self.all_feature_counts, context_at_t,
                                           self.observation_action_at_t)
 
             # If some of the actions have not been chosen yet - choose them.
@@ -252,8 +259,14 @@ class SimOOSAlgorithm:
 
         action_at_t = pool_indices[action_index_at_t]
 
-        s_t = utilities.state_extract(self.feature_values, self.all_feature_counts, context_at_t,
-                                      self.observation_action_at_t)
+        # observation at time t, first all possible observations are tried once
+        o_t = t if t < self.number_of_perms else self.index_of_observation_action_at_t
+
+        # Context is encoded once, then both its state and the states of its substates are numbered from it.
+        encoded_context = utilities.state_encode(
+            self.feature_value_to_index, context_at_t, self.observation_action_at_t
+        )
+        s_t = int(utilities.encoded_state_extract(encoded_context, self.perm_multipliers[o_t]))
 
         if t < self.number_of_perms:
             # Random Source Selection Part
@@ -285,11 +298,11 @@ class SimOOSAlgorithm:
                                                                                         action_at_t, s_t, self.index_of_observation_action_at_t] + 1
             # Update counters for all substates of the seen state.
             substates, substate_observations = utilities.generate_substates(
-                context_at_t, self.observation_action_at_t
+                encoded_context, self.observation_action_at_t
             )
-            for sub, sub_obs in zip(substates, substate_observations):
-                sub_s_t = utilities.state_extract(self.feature_values, self.all_feature_counts, sub, sub_obs)
-                sub_obs_index = self.perm_to_index[tuple(sub_obs)]
+            sub_obs_indices = [self.perm_to_index[tuple(sub_obs)] for sub_obs in substate_observations]
+            sub_s_ts = utilities.encoded_state_extract(substates, self.perm_multipliers[sub_obs_indices])
+            for sub_obs_index, sub_s_t in zip(sub_obs_indices, sub_s_ts):
                 self.N_t_o[sub_obs_index] += 1
                 self.N_t_os[sub_obs_index, sub_s_t] += 1
                 self.d_t_os[sub_obs_index, :] = self.N_t_os[sub_obs_index, :] / self.N_t_o[sub_obs_index]
@@ -1,3 +1,4 @@
+import math
 import numpy as np
 
 
@@ -17,27 +18,58 @@ class UCB1:
         self.q = np.zeros(n_arms)  # average reward for each arm
         self.n = np.ones(n_arms)  # number of times each arm was chosen
 
+        # alpha * log(trial + 1) only changes with the trial, so it is cached between calls.
+        self._log_trial = -1
+        self._log_cache = 0.0
+        # Preallocated buffer for the upper confidence bounds, sized to the largest possible pool.
+        self._ucb_buf = np.empty(n_arms)
+
     def choose_arm(self, trial, context, pool_indices):
         """
         Returns the best arm's index relative to the pool of indices
         """
+        if trial != self._log_trial:
+            self._log_cache = self.alpha * math.log(trial + 1)
+            self._log_trial = trial
+
+        # Pool is converted once per call and then used for both gathers.
+        pool = np.asarray(pool_indices, dtype=np.intp)
+
+        ucbs = self._ucb_buf[:len(pool)]
+        np.divide(self._log_cache, self.n[pool], out=ucbs)
+        np.sqrt(ucbs, out=ucbs)
+        np.add(ucbs, self.q[pool], out=ucbs)
+        return int(ucbs.argmax())
+
+    def choose_arm_batch(self, trials, pool_matrix):
+        """
+        Returns the best arm's index relative to the pool of indices for each trial of a block of trials
+
+        Row i of pool_matrix is the pool of indices of trials[i]. Gives the same arms as calling choose_arm
+        for each trial, as long as update is not called in between (e.g. for trials rejected by a replay evaluator).
+        """
+        trials = np.asarray(trials)
+        pool_matrix = np.asarray(pool_matrix, dtype=np.intp)
 
-        ucbs = self.q[pool_indices] + np.sqrt(
-            self.alpha * np.log(trial + 1) / self.n[pool_indices]
+        ucbs = self.q[pool_matrix] + np.sqrt(
+            (self.alpha * np.log(trials + 1))[:, None] / self.n[pool_matrix]
         )
-        return np.argmax(ucbs)
+        return ucbs.argmax(axis=1)
 
     def update(self, trial, displayed_article_index, reward, cost, context, pool_indices):
         """
         Updates algorithm's parameters: q, n
         """
 
-        chosen_arm_index = pool_indices[displayed_article_index]
+        # Only one element of the pool is needed here, so it is read directly without converting the pool.
+        chosen_arm_index = int(pool_indices[displayed_article_index])
 
-        self.n[chosen_arm_index] += 1
-        self.q[chosen_arm_index] += (reward - self.q[chosen_arm_index]) / self.n[
-            chosen_arm_index
-        ]
+        # Scalar updates are done on Python floats, each array element is read and written once.
+        n, q = self.n, self.q
+        n_chosen = n.item(chosen_arm_index) + 1.0
+        q_chosen = q.item(chosen_arm_index)
+        n[chosen_arm_index] = n_chosen
+        q[chosen_arm_index] = q_chosen + (reward - q_chosen) / n_chosen
 
     def choose_features_to_observe(self, trial, feature_indices, cost_vector):
         # UCB1 observes no features.
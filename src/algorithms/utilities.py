@@ -1,10 +1,17 @@
 # This file contains utility functions for SimOOS and similar algorithms. Most of them have to do with
 # states (partial vectors) and observations (feature subsets).
 from collections import defaultdict
+import functools
 import itertools
+import math
+import numba
 import numpy as np
 
+# Enables sanity checks of states and observations. They run on every trial, so they are off by default.
+VALIDATE = False
 
+
+@functools.lru_cache(maxsize=None)
 def full_perm_construct(size: int) -> np.array:
     """Constructs all possible observation actions up to length 'size'.
 
@@ -15,13 +22,15 @@ def full_perm_construct(size: int) -> np.array:
         ...
         [1., 1., 0.],
         [1., 1., 1.]])
+
+    Row i is the binary representation of i, obtained by unpacking the bytes of a big-endian integer range.
+    Results are cached by size, so the returned array is read-only.
     """
-    all_perms = np.zeros((2 ** size, size))
+    indices = np.arange(2 ** size, dtype='>u8').view(np.uint8).reshape(-1, 8)
+    bits = np.unpackbits(indices, axis=1)[:, 64 - size:]
 
-    for i in range(2 ** size):
-        bin_str = np.binary_repr(i, width=size)
-        bin_arr = np.fromstring(bin_str, 'u1') - ord('0')
-        all_perms[i, :] = bin_arr
+    all_perms = bits.astype(np.float64)
+    all_perms.flags.writeable = False
 
     return all_perms
 
@@ -36,45 +45,40 @@ def perm_construct(context_dimensionality: int, max_num_observations: int) -> np
     if context_dimensionality == max_num_observations:
         return full_perm_construct(context_dimensionality)
 
+    all_perms = []
     for i in range(0, max_num_observations + 1):
+        # Place i ones directly at every combination of positions, C(n, i) rows instead of n! permutations.
+        p = np.zeros((math.comb(context_dimensionality, i), context_dimensionality))
+        for row, positions in enumerate(itertools.combinations(range(context_dimensionality), i)):
+            p[row, list(positions)] = 1
 
-        temp1 = np.array([1 for j in range(i)])
-
-        temp2 = np.array([0 for j in range(context_dimensionality - i)])
-
-        temp_together = np.concatenate((temp1, temp2))
-
-        temp = list(itertools.permutations(temp_together))
-
-        p = np.unique(temp, axis=0)
-
-        if i == 0:
-            all_perms = p
-        else:
-            all_perms = np.concatenate((all_perms, p), axis=0)
+        # Combinations come in descending order of binary vectors, reverse them to keep the ascending order.
+        all_perms.append(p[::-1])
 
-    return all_perms
+    return np.concatenate(all_perms, axis=0)
 
 
 def save_feature_values(all_contexts) -> tuple:
-    """Save unique values for each feature and their count.
+    """Save unique values for each feature, their count and the index of each value.
 
     This is used in SimOOS and similar algorithms to enumerate all possible states and get index of state from
     observed context (state = partial vector in paper).
     """
     context_dimensionality = all_contexts.shape[1]
     feature_values = defaultdict(list)
+    feature_value_to_index = defaultdict(dict)
     feature_counts = np.zeros(context_dimensionality)
 
     for i in range(context_dimensionality):
-        unique_features = np.unique(all_contexts[:, i])
-        # None represents not observed feature
-        values = sorted(list(unique_features))
+        # np.unique already returns sorted values.
+        values = np.unique(all_contexts[:, i]).tolist()
         feature_values[i] = values
+        # Inverse lookup of feature_values[i], so that state_extract does not scan the list.
+        feature_value_to_index[i] = {value: j for j, value in enumerate(values)}
 
         feature_counts[i] = len(values)
 
-    return feature_values, feature_counts
+    return feature_values, feature_counts, feature_value_to_index
 
 
 def state_construct(all_feature_counts: np.array, all_contexts: np.array, one_perm: np.array) -> tuple:
@@ -136,7 +140,23 @@ def state_extract_old(feature_values, all_feature_counts, context_at_t, observat
     return int(state_index)
 
 
-def state_extract(feature_values, all_feature_counts, context_at_t, observation_action_at_t) -> int:
+def state_multipliers(all_feature_counts: np.array, observation_action: np.array) -> np.array:
+    """Positional multipliers of features for a given observation, as used by state_extract.
+
+    Multiplier of an observed feature is the product of value counts of all observed features after it.
+    Not observed features get multiplier 0, so that the state index is a dot product of multipliers
+    and value indices.
+    """
+    observed = observation_action == 1
+    counts = np.where(observed, all_feature_counts, 1).astype(np.int64)
+
+    multipliers = np.ones_like(counts)
+    multipliers[:-1] = np.cumprod(counts[::-1])[::-1][1:]
+
+    return np.where(observed, multipliers, 0)
+
+
+def state_extract(feature_value_to_index, all_feature_counts, context_at_t, observation_action_at_t) -> int:
     """Return the state number by context and observation.
 
     The idea is to number different states for a given observation.
@@ -149,28 +169,84 @@ def state_extract(feature_values, all_feature_counts, context_at_t, observation_
 
     context_at_t contains None values at those indices where observation_action_at_t is 0 - these are
     not observed features.
+
+    feature_value_to_index[i] maps values of feature i to their index in feature_values[i].
     """
-    context_dimensionality = context_at_t.shape[0]
-    for feature, observation in zip(context_at_t, observation_action_at_t):
-        # Sanity check
-        if observation == 1:
-            assert feature is not None
-        else:
-            assert feature is None
+    if __debug__ and VALIDATE:
+        for feature, observation in zip(context_at_t, observation_action_at_t):
+            # Sanity check
+            if observation == 1:
+                assert feature is not None
+            else:
+                assert feature is None
+
+    observed_features = np.flatnonzero(observation_action_at_t)
 
     # index of given context out of all states for this observation (from 0 to s_o[i]-1)
     state_index = 0
-    for i in range(context_dimensionality):
-        if not observation_action_at_t[i]:
-            continue
-        state_index *= all_feature_counts[i]
+    for i in observed_features:
         # index of feature value of all possible values for this feature
-        feature_index = feature_values[i].index(context_at_t[i])
-        state_index += feature_index
+        feature_index = feature_value_to_index[i][context_at_t[i]]
+        state_index = state_index * int(all_feature_counts[i]) + feature_index
 
     return int(state_index)
 
 
+def make_state_extract(feature_value_to_index, all_feature_counts, observation_action):
+    """Generate a version of state_extract specialized for one fixed observation.
+
+    Observed features, their multipliers and value lookups are inlined into the source of the generated function,
+    so that it only takes the context: make_state_extract(...)(context_at_t) == state_extract(..., context_at_t, ...).
+    """
+    multipliers = state_multipliers(all_feature_counts, observation_action)
+    observed_features = np.flatnonzero(observation_action)
+
+    terms = [f"{int(multipliers[i])} * index_{i}[context_at_t[{i}]]" for i in observed_features]
+    source = f"def specialized_state_extract(context_at_t):\n    return {' + '.join(terms) or '0'}\n"
+
+    namespace = {f"index_{i}": feature_value_to_index[i] for i in observed_features}
+    exec(source, namespace)
+
+    return namespace["specialized_state_extract"]
+
+
+def state_encode(feature_value_to_index, partial_vector, observation_action) -> np.array:
+    """Encode partial vector as indices of its feature values.
+
+    Not observed features are encoded by 0, observed ones by index of their value in feature_values[i] plus 1.
+    Encoded vectors are fixed width integer arrays, so substates can be generated and numbered without
+    going through Python objects.
+    """
+    encoded_vector = np.zeros(partial_vector.shape[0], dtype=np.uint16)
+    for i in np.flatnonzero(observation_action):
+        encoded_vector[i] = feature_value_to_index[i][partial_vector[i]] + 1
+
+    return encoded_vector
+
+
+def contexts_to_feature_indices(feature_values, all_contexts: np.array) -> np.array:
+    """Replace every value in the context matrix by its index in feature_values (see save_feature_values).
+
+    Full contexts are assumed, so the state numbers of all contexts for an observation are
+    contexts_to_feature_indices(...) @ state_multipliers(...).
+    """
+    feature_indices = np.zeros(all_contexts.shape, dtype=np.int64)
+    for i in range(all_contexts.shape[1]):
+        feature_indices[:, i] = np.searchsorted(np.array(feature_values[i]), all_contexts[:, i])
+
+    return feature_indices
+
+
+def encoded_state_extract(encoded_vectors, multipliers):
+    """Return the state number of an encoded partial vector (see state_encode and state_extract).
+
+    encoded_vectors can also be a matrix with one encoded vector per row, then multipliers
+    (see state_multipliers) are given for each row and an array of state numbers is returned.
+    """
+    # Not observed features have multiplier 0, so the -1 offset only applies to observed ones.
+    return ((encoded_vectors.astype(np.int64) - 1) * multipliers).sum(axis=-1)
+
+
 def state_create(state_index, feature_values):
     """Create partial vector from state_index.
 
@@ -200,48 +276,53 @@ def is_round_over(N_old, N):
 
     flag = 1 - round is over, flag = 0 - round is not over.
     """
-    flag = int(((N-N_old) >= np.maximum(N_old, 1)).any())
+    flag = int(_any_count_doubled(np.ravel(N_old), np.ravel(N)))
 
     return flag
 
 
+@numba.njit(cache=True)
+def _any_count_doubled(N_old, N):
+    """Compiled check of is_round_over, returns on the first count that doubled without temporary arrays."""
+    for i in range(N.shape[0]):
+        if N[i] - N_old[i] >= max(N_old[i], 1):
+            return True
+    return False
+
+
 def generate_substate_observations(observation: np.array) -> np.array:
-    """Generate binary vectors that correspond to subsets of a given observation."""
-    all_perms = full_perm_construct(observation.shape[0])
+    """Generate binary vectors that correspond to subsets of a given observation.
 
-    substate_observations = np.multiply(all_perms, observation)
+    Only the observed features are enumerated, so there are 2^k substate observations for k observed features.
+    Rows are in ascending order, same as np.unique would return them.
+    """
+    observed_features = np.flatnonzero(observation)
 
-    substate_observations = np.unique(substate_observations, axis=0)
+    substate_observations = np.zeros((2 ** observed_features.shape[0], observation.shape[0]))
+    substate_observations[:, observed_features] = full_perm_construct(observed_features.shape[0])
 
     return substate_observations
 
 
-def get_substate(vector: np.array, substate_observation: np.array) -> np.array:
-    """Get a substate of a given vector specified by the substate_observation"""
+def get_substate(encoded_vector: np.array, substate_observation: np.array) -> np.array:
+    """Get a substate of a given encoded vector (see state_encode) specified by the substate_observation"""
     # Sanity check: make sure that substate_observation is not larger - that it is 0 where vector is not observed.
-    for i in range(substate_observation.shape[0]):
-        if vector[i] is None:
-            assert substate_observation[i] == 0
-
-    substate = np.array([
-        vector[i] if substate_observation[i] == 1 else None
-        for i in range(substate_observation.shape[0])
-    ])
+    if __debug__ and VALIDATE:
+        assert not (substate_observation.astype(bool) & (encoded_vector == 0)).any()
 
-    return substate
+    return np.where(substate_observation.astype(bool), encoded_vector, 0).astype(encoded_vector.dtype)
 
 
-def generate_substates(partial_vector: np.array, observation: np.array) -> tuple:
-    """Generate all substates of a given partial vector and observation.
+def generate_substates(encoded_vector: np.array, observation: np.array) -> tuple:
+    """Generate all substates of a given encoded partial vector (see state_encode) and observation.
 
     Substate is a partial vector, whose domain is a subset of domain of a given vector and also substate and given
     vector must both be consistent to some full vector in their domaints. For details refer to SimOOS paper.
+
+    Substates are returned encoded, one substate per row.
     """
     substate_observations = generate_substate_observations(observation)
-    substates = np.zeros(substate_observations.shape, dtype=object)
-    for i, substate_obs in enumerate(substate_observations):
-        substate_vector = get_substate(partial_vector, substate_obs)
-        substates[i, :] = substate_vector
+    substates = get_substate(encoded_vector, substate_observations)
     return substates, substate_observations
 
 
@@ -61,6 +61,9 @@ def evaluate_on_synthetic_data(
     cumulative_gain = []  # contains cumulative gain for each trial
     chosen_arms = []  # contains arms chosen in each trial
 
+    # Pool of arms is the same for every trial, so it is created once.
+    pool_indices = list(range(num_arms))
+
     for trial in range(num_trials):
 
         context_at_t = contexts[trial]
@@ -76,7 +79,6 @@ def evaluate_on_synthetic_data(
             ]
         )
 
-        pool_indices = list(range(num_arms))
         chosen_arm_index = bandit_algorithm.choose_arm(
             trial, observed_features, pool_indices
         )